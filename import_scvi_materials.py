@@ -21,11 +21,19 @@
 from enum import Enum
 from collections import namedtuple
 from pathlib import Path
-from typing import Any
+from typing import Any, NamedTuple, Optional
 
-import json
+import concurrent.futures
+import functools
 import os
 import re
+import sys
+
+try:
+    # orjson is a lot faster than the json module, but is not shipped with Blender
+    from orjson import loads as loads_json
+except ImportError:
+    from json import loads as loads_json
 
 # Blender
 import bpy
@@ -41,6 +49,30 @@ CHARA_DLC_MAP = {
     22: 11, # Setsuka
     9:  13  # Hwang
 }
+# Directories relative to the export directory that are searched for resources
+BASIC_RESOURCE_DIR = os.path.join("Common", "BasicResource")
+CHARA_CMN_MATERIAL_DIR = os.path.join("Chara", "CMN", "Material")
+CHARA_CMN_TEXTURE_DIR = os.path.join("Chara", "CMN", "Texture")
+
+# Directories searched for bare resource names, in order
+CHARA_MAT_SEARCH_DIRS = (BASIC_RESOURCE_DIR, CHARA_CMN_MATERIAL_DIR)
+TEXTURE_SEARCH_DIRS = (BASIC_RESOURCE_DIR, CHARA_CMN_TEXTURE_DIR)
+
+def normcase_file_name(name: str) -> str:
+    """Normalizes the case of a file name the way the file system compares it"""
+    # os.path.normcase leaves names alone on macOS, even though its file systems ignore case by default
+    if sys.platform == "darwin":
+        return name.lower()
+    return os.path.normcase(name)
+
+@functools.lru_cache(maxsize = 256)
+def chara_material_dir(characterId: int) -> str:
+    """Returns the material directory of a character, relative to the export directory"""
+    # FIXME: check which characters are actually DLC
+    if characterId in CHARA_DLC_MAP:
+        dlcNo = CHARA_DLC_MAP[characterId]
+        return os.path.join("DLC", f"{dlcNo:02}", "Chara", f"{characterId:03}", "Material")
+    return os.path.join("Chara", f"{characterId:03}", "Material")
 
 class ResourceType(Enum):
     UNKNOWN = 0
@@ -54,186 +86,257 @@ class ResourceType(Enum):
     
     @classmethod
     def fromString(cls, string: str):
-        if string == "MaterialInstanceConstant":
-            return cls.CHARA_MAT
-        if string == "Material3":
-            return cls.CHARA_MAT
-        if string == "Texture2D":
-            return cls.TEXTURE_2D
-        return cls.UNKNOWN
+        return RESOURCE_TYPE_NAMES.get(string, cls.UNKNOWN)
+
+# Resource types of the object types that are referenced by name in property files
+RESOURCE_TYPE_NAMES = {
+    "MaterialInstanceConstant": ResourceType.CHARA_MAT,
+    "Material3":                ResourceType.CHARA_MAT,
+    "Texture2D":                ResourceType.TEXTURE_2D
+}
 
 class ResourceResolver:
     """Resolves the path to a resource"""
-    basePath: Path
+    _basePath: Path
     
     def __init__(self, basePath = None):
         if basePath:
-            self.basePath = basePath
+            self._basePath = Path(basePath)
         else:
-            self.basePath = Path.home() / "UmodelExport"
+            self._basePath = Path.home() / "UmodelExport"
+        self._basePathStr: str = os.fspath(self._basePath)
+        
+        # Results of earlier lookups, so the file system only gets hit once per path/resource
+        self._existsCache: dict[str, bool] = {}
+        self._resolveCache: dict[tuple[ResourceType, str], Path] = {}
+        # File names in the directories that have been searched so far, relative to basePath. Maps the
+        # case-normalized name to the name on disk, so lookups ignore case where the file system does.
+        self._directoryIndex: dict[str, dict[str, str]] = {}
+        # Every distinct scalar, vector and reference property parsed so far, so equal ones are shared
+        self._propertyPool: dict["Property", "Property"] = {}
+        # Every property file built so far, by path
+        self._propertyCache: dict[Path, "PropertyFile"] = {}
+    
+    @property
+    def basePath(self) -> Path:
+        """The export directory. Fixed at construction, as every cached lookup depends on it."""
+        return self._basePath
+    
+    def _exists(self, path: str) -> bool:
+        """Checks whether a path exists, remembering the result"""
+        exists = self._existsCache.get(path)
+        if exists is None:
+            exists = self._existsCache[path] = os.path.exists(path)
+        return exists
+    
+    def _listDirectory(self, directory: str) -> dict[str, str]:
+        """Returns the names of the files in a directory relative to basePath, by case-normalized name"""
+        files = self._directoryIndex.get(directory)
+        if files is None:
+            # List every candidate directory once instead of probing it for every lookup
+            try:
+                with os.scandir(os.path.join(self._basePathStr, directory)) as entries:
+                    files = {normcase_file_name(entry.name): entry.name for entry in entries}
+            except (FileNotFoundError, NotADirectoryError):
+                files = {}
+            files = self._directoryIndex.setdefault(directory, files)
+        return files
+    
+    def _findInDirectories(self, directories: tuple[str, ...], fileName: str) -> Optional[Path]:
+        """Returns the path of the first file named fileName in directories, using its name on disk"""
+        key = normcase_file_name(fileName)
+        for directory in directories:
+            diskName = self._listDirectory(directory).get(key)
+            if diskName is not None:
+                return Path(self._basePathStr, directory, diskName)
+        return None
     
     def resolveResourcePath(self, resType: ResourceType, name: str) -> Path:
         """Finds the path to a given resource"""
+        key = (resType, name)
+        if key in self._resolveCache:
+            return self._resolveCache[key]
+        
+        path = self._findResourcePath(resType, name)
+        self._resolveCache[key] = path
+        return path
+    
+    def _findResourcePath(self, resType: ResourceType, name: str) -> Path:
+        """Searches the candidate directories for a given resource"""
         if "/" in name:
-            path: Path = Path(self.basePath, name)
+            path: str = os.path.join(self._basePathStr, name)
             
-            if path.stem == path.suffix[1:]:
+            root, suffix = os.path.splitext(path)
+            if os.path.basename(root) == suffix[1:]:
                 if resType == ResourceType.TEXTURE_2D:
-                    path = path.with_suffix(".tga")
+                    path = root + ".tga"
                 elif resType == ResourceType.CHARA_MAT:
-                    path = path.with_suffix(".props.json")
+                    path = root + ".props.json"
                 else:
                     print("Suffix same as stem, unknown file type")
 
-            if path.exists():
-                return path
+            if self._exists(path):
+                return Path(path)
         else:
-            paths: list[Path] = [Path("Common/BasicResource")]
             if resType == ResourceType.CHARA_MAT:
-                characterId: int = 0
-                dlcNo: int = 0
-                
-                paths += [Path("Chara/CMN/Material")]
+                paths: tuple[str, ...] = CHARA_MAT_SEARCH_DIRS
                 
-                m = CHARA_MAT_RE.match(name)
+                # Only names containing "_R" can match, skip the regex for all other names
+                m = CHARA_MAT_RE.match(name) if "_R" in name else None
                 if m:
-                    characterId = int(m.group(1))
-                    # FIXME: check which characters are actually DLC
-                    if characterId in CHARA_DLC_MAP:
-                        dlcNo = CHARA_DLC_MAP[characterId]
-                        paths += [Path("DLC/{0:0>2}/Chara/{1:0>3}/Material".format(dlcNo, characterId))]
-                    else:
-                        dlcNo = 0
-                        paths += [Path("Chara/{0:0>3}/Material".format(characterId))]
-                        
-                for path in paths:
-                    matPath: Path = Path(self.basePath, path, name + ".props.json")
-                    if matPath.exists():
-                        return matPath
-                    
+                    paths += (chara_material_dir(int(m.group(1))),)
+                
+                return self._findInDirectories(paths, name + ".props.json")
             elif resType == ResourceType.TEXTURE_2D:
-                paths += [Path("Chara/CMN/Texture")]
-                for path in paths:
-                    texPath: Path = Path(self.basePath, path, name + ".tga")
-                    if texPath.exists():
-                        return texPath
+                return self._findInDirectories(TEXTURE_SEARCH_DIRS, name + ".tga")
             
             
         return None
     
-    def readResource(self, resType: ResourceType, name: str) -> str:
-        """Reads a resource to a string"""
+    def readResource(self, resType: ResourceType, name: str) -> bytes:
+        """Reads the raw contents of a resource"""
         path = self.resolveResourcePath(resType, name)
         if not path:
             print("Could not find resource {0} of type {1}".format(name, resType))
             return None
-        with open(path, "r") as f:
-            return f.read()
+        return path.read_bytes()
+    
+    def internProperty(self, prop: "Property") -> "Property":
+        """Returns the shared instance of a property equal to prop. The value of prop must be hashable."""
+        return self._propertyPool.setdefault(prop, prop)
+    
+    def getPropertyFile(self, resType: ResourceType, name: str) -> Optional["PropertyFile"]:
+        """Returns the property file of a resource, merged with its parents.
+        
+        Every resource is only read and built once, after that the cached property file is returned."""
+        path = self.resolveResourcePath(resType, name)
+        if path in self._propertyCache:
+            return self._propertyCache[path]
+        
+        # Walk up the parents until one that has been built before, parsing every file on the way
+        chain: list[tuple[Path, PropertyFile]] = []
+        seen: set[Path] = set()
+        while path not in self._propertyCache and path not in seen:
+            contents = self.readResource(resType, name)
+            if contents is None:
+                break
+            
+            propertyFile: PropertyFile = PropertyFile(contents, self)
+            propertyFile.parse()
+            chain.append((path, propertyFile))
+            seen.add(path)
+            
+            if not propertyFile.parent:
+                break
+            resType, name = propertyFile.parent.propertyType, propertyFile.parent.value
+            path = self.resolveResourcePath(resType, name)
+        
+        # Then merge them on the way back down, every file only has to be merged with its direct parent.
+        # Merge into flat dicts, so lookups never have to go through more than one level.
+        parentProperties = self._propertyCache[path].properties if path in self._propertyCache else {}
+        for filePath, propertyFile in reversed(chain):
+            properties = dict(parentProperties)
+            properties.update(propertyFile.properties)
+            propertyFile.properties = properties
+            self._propertyCache[filePath] = propertyFile
+            parentProperties = properties
+        
+        return chain[0][1] if chain else None
 
 
 
-class Property:
-    """The type of this property"""
-    propertyType: ResourceType
+class Property(NamedTuple):
+    """A value and the type of this property"""
     value: Any = None
+    propertyType: ResourceType = ResourceType.UNKNOWN
     
-    def __init__(self, value: Any = None, propertyType: ResourceType = ResourceType.UNKNOWN):
-        self.propertyType = propertyType
-        self.value = value
-        
     def __repr__(self):
         return "{0} ({1})".format(self.value, self.propertyType)
 
+def add_scalar_properties(propertyFile: "PropertyFile", params: list) -> None:
+    intern = propertyFile.resourceResolver.internProperty
+    for param in params:
+        propertyFile.properties[param["ParameterName"]] = intern(Property(float(param["ParameterValue"]), ResourceType.FLOAT))
+
+def add_texture_properties(propertyFile: "PropertyFile", params: list) -> None:
+    for param in params:
+        propertyFile.properties[param["ParameterName"]] = propertyFile.parseProperty(param["ParameterValue"])
+
+def add_vector_properties(propertyFile: "PropertyFile", params: list) -> None:
+    intern = propertyFile.resourceResolver.internProperty
+    for param in params:
+        param_value = param["ParameterValue"]
+        # Stored as a tuple, so equal vectors can be shared
+        propertyFile.properties[param["ParameterName"]] = intern(Property((float(param_value["R"]),
+                                                                           float(param_value["G"]),
+                                                                           float(param_value["B"]),
+                                                                           float(param_value["A"])),
+                                                                          ResourceType.VECTOR_4))
+
+# Handlers for the XParameterValues keys of a property file, by X
+PARAM_VALUES_SUFFIX = "ParameterValues"
+PARAM_VALUES_HANDLERS = {
+    "Scalar":  add_scalar_properties,
+    "Texture": add_texture_properties,
+    "Vector":  add_vector_properties
+}
+
 class PropertyFile:
     resourceResolver: ResourceResolver
-    contents: str
+    contents: Optional[bytes]
     
-    properties: dict[str, Property] = {}
-    parent: Property = None
+    properties: dict[str, Property]
+    parent: Optional[Property]
     
-    def __init__(self, contents: str, resourceResolver: ResourceResolver):
+    def __init__(self, contents: bytes, resourceResolver: ResourceResolver):
         """Creates a property file from a path"""
         self.resourceResolver = resourceResolver
         self.contents = contents
+        self.properties = {}
+        self.parent = None
     
     def parse(self) -> None:
         """Parses the properties out of the contents into this string"""
-        data = json.loads(self.contents)
+        # The raw contents are not needed after parsing, so don't keep them alive in the resolver's cache
+        contents = self.contents
+        self.contents = None
+        
+        # Placeholder files only contain an empty object, there is nothing to decode in them. Check the length
+        # first, so the contents of real files are not copied by strip().
+        if len(contents) < 16 and contents.strip() == b"{}":
+            return
+        
+        data = loads_json(contents)
         
         for propName, propValue in data.items():
-            
-            def add_properties(typeName: str, nameKey: str, valueKey: str) -> None:
+            if propName == "Parent":
+                self.parent = self.parseProperty(propValue)
+            elif propName.endswith(PARAM_VALUES_SUFFIX):
                 # Workaround for empty property values that are generated with a "{}" string
                 if type(propValue) is str and propValue == "{}":
-                    return
-                if typeName == "Scalar":
-                    for param in propValue:
-                        param_name = param[nameKey]
-                        param_value = param[valueKey]
-                        
-                        self.properties[param_name] = Property(float(param_value), ResourceType.FLOAT)
-                elif typeName == "Texture":
-                    for param in propValue:
-                        param_name = param[nameKey]
-                        param_value = param[valueKey]
-                        
-                        self.properties[param_name] = self.parseProperty(param_value)
-                elif typeName == "Vector":
-                    for param in propValue:
-                        param_name = param[nameKey]
-                        param_value = param[valueKey]
-                        
-                        self.properties[param_name] = Property([float(param_value["R"]), 
-                                                                float(param_value["G"]),
-                                                                float(param_value["B"]),
-                                                                float(param_value["A"])],
-                                                               ResourceType.VECTOR_4)
+                    continue
+                typeName = propName[:-len(PARAM_VALUES_SUFFIX)]
+                handler = PARAM_VALUES_HANDLERS.get(typeName)
+                if handler:
+                    handler(self, propValue)
                 else:
                     print("Discarded property of type {0}".format(typeName))
-            if propName == "Parent":
-                self.parent = self.parseProperty(data["Parent"])
-            elif "ParameterValues" in propName:
-                typeName, _ = propName.split("ParameterValues")
-                add_properties(typeName, "ParameterName", "ParameterValue")
-                    
-            elif propName.startswith("Collected") and propName.endswith("Parameters"):
-                # Handle CollectedXParameters
-                typeName = propName[len("Collected"):-len("Parameters")]
-                #if typeName == "Texture":
-                #    add_properties(typeName, "Name", "Texture")
-                #else:
-                #    add_properties(typeName, "Name", "Value")
-                
-
+            # CollectedXParameters are ignored for now, they use "Name" and "Value"/"Texture" keys
+            # instead of "ParameterName" and "ParameterValue".
     
-    def build(self) -> None:
-        """Parses the file and merges it with its parents"""
-        self.parse()
-        self.mergeWithParents()
+    def getValue(self, name: str, default: Any = None) -> Any:
+        """Returns the value of a property, or default if there is no such property"""
+        prop = self.properties.get(name)
+        return default if prop is None else prop.value
     
     def parseProperty(self, value: Any, typeHint: ResourceType = ResourceType.UNKNOWN) -> Property:
         if type(value) is str and value.endswith("'"):
-            typeName, propertyValue, _ = value.split("'")
-            return Property(propertyValue, ResourceType.fromString(typeName))
+            # References look like TypeName'Path/To/Object.Object'
+            first = value.find("'")
+            return self.resourceResolver.internProperty(Property(value[first + 1:-1],
+                                                                 ResourceType.fromString(value[:first])))
         
         return Property(value, typeHint)
-    
-    
-    def mergeWithParents(self) -> None:
-        """Merges all parent properties into this file"""
-        #print(repr(self.properties))
-        if self.parent:
-            parent: PropertyFile = PropertyFile(self.resourceResolver.readResource(self.parent.propertyType, self.parent.value), 
-                                                self.resourceResolver)
-            parent.build()
-            #print(self.parent.value))
-            for parentPropName, parentPropValue in parent.properties.items():
-                if parentPropName in self.properties:
-                    pass
-                    #print("    {0}: {1}, parent: {2} (overridden)".format(parentPropName, self.properties[parentPropName], parentPropValue))
-                else:
-                    self.properties[parentPropName] = parentPropValue
-                    #print("    {0}: {1} (inherited)".format(parentPropName, parentPropValue))
 
 def register() -> None:
     pass
@@ -242,6 +345,58 @@ def register() -> None:
 # Material                                                                                #
 ###########################################################################################
 
+def load_image(img_path: Path, imageCache: Optional[dict[bytes, bpy.types.Image]] = None) -> bpy.types.Image:
+    """Loads an image, or returns it from imageCache if it has been loaded before"""
+    key = bytes(img_path)
+    if imageCache is None:
+        return bpy.data.images.load(key, check_existing=True)
+    
+    img = imageCache.get(key)
+    if img is None:
+        img = imageCache[key] = bpy.data.images.load(key, check_existing=True)
+    return img
+
+def build_node_graph(node_tree: bpy.types.NodeTree, nodeSpecs: list, linkSpecs: list,
+                     existingNodes: Optional[dict[str, bpy.types.Node]] = None) -> dict[str, bpy.types.Node]:
+    """Creates all nodes of a graph in one pass, then all links between them in another.
+    
+    nodeSpecs contains (id, node type, attributes, input default values) tuples, linkSpecs contains
+    (from id, output socket, to id, input socket) tuples. Nodes that have been created before can be
+    referenced in linkSpecs by passing them in existingNodes. Returns the nodes by id."""
+    nodes = dict(existingNodes) if existingNodes else {}
+    
+    new_node = node_tree.nodes.new
+    for node_id, node_type, attributes, defaults in nodeSpecs:
+        node = new_node(node_type)
+        for attribute, value in attributes.items():
+            setattr(node, attribute, value)
+        for socket, value in defaults.items():
+            node.inputs[socket].default_value = value
+        nodes[node_id] = node
+    
+    # Outputs are often linked to more than one input, only look each of them up once
+    output_sockets = {}
+    new_link = node_tree.links.new
+    for from_id, from_socket, to_id, to_socket in linkSpecs:
+        output_socket = output_sockets.get((from_id, from_socket))
+        if output_socket is None:
+            output_socket = output_sockets[(from_id, from_socket)] = nodes[from_id].outputs[from_socket]
+        new_link(output_socket, nodes[to_id].inputs[to_socket])
+    
+    return nodes
+
+# Creation mask channel replaced by each creation colour, as (node id, output socket) in the CREATION_MASK group
+CREATION_MASK_CHANNELS = (
+    ("split", "R"), # Colour 1 replaces red
+    ("cmp",   0),   # Colour 2 replaces black
+    ("split", "G"), # Colour 3 replaces green
+    ("split", "B")  # Colour 4 replaces blue
+)
+# Material properties with the creation colours, and the CREATION_MASK group inputs they go into
+CREATION_COLOR_PROPERTIES = ("CreationColor1", "CreationColor2", "CreationColor3", "CreationColor4")
+CREATION_COLOR_INPUTS = ("Color 1", "Color 2", "Color 3", "Color 4")
+CREATION_VALID_INPUTS = ("Valid 1", "Valid 2", "Valid 3", "Valid 4")
+
 def get_creation_mask_node(forceCreate: bool = False) -> bpy.types.ShaderNodeGroup:
     if "CREATION_MASK" in bpy.data.node_groups:
         if forceCreate:
@@ -270,75 +425,67 @@ def get_creation_mask_node(forceCreate: bool = False) -> bpy.types.ShaderNodeGro
     creation_color3_input = node_tree.inputs.new("NodeSocketColor", "Color 3")
     creation_color4_input = node_tree.inputs.new("NodeSocketColor", "Color 4")
     
+    # Colours that are not valid for a material are left out. Cycles folds the branches away when they are 0.
+    for valid_input_name in CREATION_VALID_INPUTS:
+        valid_input = node_tree.inputs.new("NodeSocketFloat", valid_input_name)
+        valid_input.default_value = 1.0
+        valid_input.min_value = 0.0
+        valid_input.max_value = 1.0
+    
     color_output = node_tree.outputs.new("NodeSocketColor", "Color")
     
     # Nodes
-    creation_mask_split_node = nodes.new("ShaderNodeSeparateRGB")
-    node_tree.links.new(group_input.outputs["Creation Mask"], creation_mask_split_node.inputs["Image"])
-    creation_mask_split_node.location = (-2500, 150)
-    
-    prev_color_node = group_input
+    # Determine if something is black by checking if every element is 0. This is only needed once, no
+    # matter which colour ends up using it.
+    node_specs = [
+        ("split",  "ShaderNodeSeparateRGB", {"location": (-2500, 150)},                         {}),
+        ("length", "ShaderNodeVectorMath",  {"location": (-2000, 500), "operation": "LENGTH"},  {}),
+        ("cmp",    "ShaderNodeMath",        {"location": (-1750, 500), "operation": "COMPARE"}, {1: 0.0})
+    ]
+    link_specs = [
+        ("input",  "Creation Mask", "split", "Image"),
+        ("input",  "Creation Mask", "length", "Vector"),
+        ("length", "Value",         "cmp",    0)
+    ]
+    
+    prev_color_socket = ("input", "Base Color")
     
     for i in range(4):
-        math_node = nodes.new("ShaderNodeMath")
-        math_node.location = (-2000 + 500 * i, 300 )
-        math_node.operation = "MULTIPLY"
-        
-        mul_node = nodes.new("ShaderNodeMixRGB")
-        mul_node.location =  (-2000 + 500 * i, -300 )
-        mul_node.blend_type = "MULTIPLY"
-        mul_node.inputs["Fac"].default_value = 1.0
+        math_id = "math{0}".format(i)
+        valid_id = "valid{0}".format(i)
+        mul_id = "mul{0}".format(i)
+        mix_id = "mix{0}".format(i)
         
-        mix_node = nodes.new("ShaderNodeMixRGB")
-        mix_node.location =  (-1500 + 500 * i, 0 )
         #if "IsSkin" in p.properties and p.properties["IsSkin"] != 0.0:
-        mix_node.blend_type = "MIX"
-        
-        node_tree.links.new(group_input.outputs["Base Color"], mul_node.inputs["Color1"])
-        node_tree.links.new(group_input.outputs["Color {0}".format(i + 1)], mul_node.inputs["Color2"])
-        node_tree.links.new(group_input.outputs["Creation Mask Alpha"], math_node.inputs[1])
-        node_tree.links.new(math_node.outputs[0], mix_node.inputs["Fac"])
-        
-        color_output_name = "Color"
-        if prev_color_node == group_input:
-            color_output_name = "Base Color"
-            
-        node_tree.links.new(prev_color_node.outputs[color_output_name], mix_node.inputs["Color1"])
-        node_tree.links.new(mul_node.outputs["Color"], mix_node.inputs["Color2"])
+        node_specs += [
+            (math_id,  "ShaderNodeMath",   {"location": (-2000 + 500 * i, 300),  "operation": "MULTIPLY"}, {}),
+            (valid_id, "ShaderNodeMath",   {"location": (-1750 + 500 * i, 150),  "operation": "MULTIPLY"}, {}),
+            (mul_id,   "ShaderNodeMixRGB", {"location": (-2000 + 500 * i, -300), "blend_type": "MULTIPLY"}, {"Fac": 1.0}),
+            (mix_id,   "ShaderNodeMixRGB", {"location": (-1500 + 500 * i, 0),    "blend_type": "MIX"},      {})
+        ]
+        link_specs += [
+            ("input",  "Base Color",               mul_id,   "Color1"),
+            ("input",  CREATION_COLOR_INPUTS[i],   mul_id,   "Color2"),
+            ("input",  "Creation Mask Alpha",      math_id,  1),
+            (math_id,  0,                          valid_id, 0),
+            ("input",  CREATION_VALID_INPUTS[i],   valid_id, 1),
+            (valid_id, 0,                          mix_id,   "Fac"),
+            (*prev_color_socket,                   mix_id,  "Color1"),
+            (mul_id,  "Color",                     mix_id,  "Color2")
+        ]
         
-        if i == 0:
-            # Colour 1 replaces red
-            node_tree.links.new(creation_mask_split_node.outputs["R"], math_node.inputs[0])
-        elif i == 3:
-            # Colour 2 replaces black
-            node_tree.links.new(creation_mask_split_node.outputs["B"], math_node.inputs[0])
-        elif i == 2:
-            # Colour 3 replaces green
-            node_tree.links.new(creation_mask_split_node.outputs["G"], math_node.inputs[0])
-        elif i == 1:
-            # Colour 4 replaces blue
-            
-            # Determine if something is black by checking if every element is 0
-            length_node = nodes.new("ShaderNodeVectorMath")
-            length_node.location = (-2500 + 500 * i, 500 )
-            length_node.operation = "LENGTH"
-            
-            cmp_node = nodes.new("ShaderNodeMath")
-            cmp_node.location = (-2250 + 500 * i, 500 )
-            cmp_node.operation = "COMPARE"
-            cmp_node.inputs[1].default_value = 0.0
-            
-            node_tree.links.new(group_input.outputs["Creation Mask"], length_node.inputs["Vector"])
-            node_tree.links.new(length_node.outputs["Value"], cmp_node.inputs[0])
-            node_tree.links.new(cmp_node.outputs[0], math_node.inputs[0])
+        link_specs.append((*CREATION_MASK_CHANNELS[i], math_id, 0))
         
-        prev_color_node = mix_node
-            
-    node_tree.links.new(prev_color_node.outputs["Color"], group_output.inputs["Color"])
+        prev_color_socket = (mix_id, "Color")
+    
+    link_specs.append((*prev_color_socket, "output", "Color"))
+    
+    build_node_graph(node_tree, node_specs, link_specs, {"input": group_input, "output": group_output})
     
     return node_tree
 
-def get_eye_highlight_node(r: ResourceResolver, forceCreate: bool = False) -> bpy.types.ShaderNodeGroup:
+def get_eye_highlight_node(r: ResourceResolver, forceCreate: bool = False,
+                           imageCache: Optional[dict[bytes, bpy.types.Image]] = None) -> bpy.types.ShaderNodeGroup:
     if "EYE_HIGHLIGHT" in bpy.data.node_groups:
         if forceCreate:
             bpy.data.node_groups.remove(bpy.data.node_groups["EYE_HIGHLIGHT"])
@@ -410,9 +557,7 @@ def get_eye_highlight_node(r: ResourceResolver, forceCreate: bool = False) -> bp
     
     iris_base_color_node = nodes.new("ShaderNodeTexImage")
     iris_base_color_node.location = (-500, -300)
-    iris_base_color_node.image = bpy.data.images.load(bytes(r.resolveResourcePath(ResourceType.TEXTURE_2D, \
-                                                                                  "EyeIrisBaseColor")), \
-                                                            check_existing = True)
+    iris_base_color_node.image = load_image(r.resolveResourcePath(ResourceType.TEXTURE_2D, "EyeIrisBaseColor"), imageCache)
     node_tree.links.new(mapping_node.outputs["Vector"], iris_base_color_node.inputs["Vector"])
     
     
@@ -427,9 +572,7 @@ def get_eye_highlight_node(r: ResourceResolver, forceCreate: bool = False) -> bp
     
     sclera_base_color_node = nodes.new("ShaderNodeTexImage")
     sclera_base_color_node.location = (-500, 200)
-    sclera_base_color_node.image = bpy.data.images.load(bytes(r.resolveResourcePath(ResourceType.TEXTURE_2D, \
-                                                                                    "EyeScleraBaseColor")), \
-                                                              check_existing = True)
+    sclera_base_color_node.image = load_image(r.resolveResourcePath(ResourceType.TEXTURE_2D, "EyeScleraBaseColor"), imageCache)
     
     cmp_half_node = create_math_node(multiply_half_node.outputs["Value"], 0.5, "MULTIPLY", location = (-1000, -400))
     
@@ -456,14 +599,45 @@ def get_eye_highlight_node(r: ResourceResolver, forceCreate: bool = False) -> bp
     
     return node_tree
 
+def fixup_eyebrow(r: ResourceResolver, textureNodes: dict[str, bpy.types.ShaderNodeTexImage],
+                  imageCache: dict[bytes, bpy.types.Image]) -> None:
+    """Patches some mistakes on the eyebrow material"""
+    creation_mask_texture_node = textureNodes.get("CreationMask")
+    if creation_mask_texture_node is None:
+        return
+    
+    creation_mask_texture_path = r.resolveResourcePath(ResourceType.TEXTURE_2D, "black_16x16")
+    creation_mask_texture_node.image = load_image(creation_mask_texture_path, imageCache)
+
+def fixup_tear(r: ResourceResolver, textureNodes: dict[str, bpy.types.ShaderNodeTexImage],
+               imageCache: dict[bytes, bpy.types.Image]) -> None:
+    """Replaces the base colour texture of the tear material"""
+    base_color_node = textureNodes.get("BaseColor")
+    if base_color_node is None:
+        return
+    
+    base_color_texture_path = r.resolveResourcePath(ResourceType.TEXTURE_2D, "FACE_namida_COLOR")
+    base_color_node.image = load_image(base_color_texture_path, imageCache)
+
+# Hard-coded material fixups until the material loading is done correctly, by material name suffix
+MATERIAL_FIXUPS = {
+    "Eyebrow": fixup_eyebrow,
+    "Tear":    fixup_tear
+}
+MATERIAL_FIXUP_SUFFIXES = tuple(MATERIAL_FIXUPS)
+
 def setup_materials(r: ResourceResolver):
     
     
-    eye_data = ""
+    eye_property_file: PropertyFile = None
+    
+    # Images loaded during this run, so textures shared by materials are only passed to Blender once. This is
+    # not kept between runs, as the images may have been removed from the file in the meantime.
+    img_cache: dict[bytes, bpy.types.Image] = {}
     
     # Fore the recreation
     get_creation_mask_node(True)
-    get_eye_highlight_node(r, True)
+    get_eye_highlight_node(r, True, img_cache)
     
     def create_texture_node(prop: Property) -> bpy.types.ShaderNodeTexImage:
         node = nodes.new("ShaderNodeTexImage")
@@ -472,13 +646,13 @@ def setup_materials(r: ResourceResolver):
         else:
             img_path = r.resolveResourcePath(prop.propertyType, prop.value)
         if img_path is not None:
-            node.image = bpy.data.images.load(bytes(img_path), check_existing=True)
+            node.image = load_image(img_path, img_cache)
         return node
     
     def add_remap_nodes(propertyName: str, outputSocket, inputSocket, nodeLocation) -> None:
         if "SpecularMin" in p.properties or "SpecularMax" in p.properties:
-            prop_min = p.properties["{0}Min".format(propertyName)].value if "{0}Min".format(propertyName) in p.properties else 0.0
-            prop_max = p.properties["{0}Max".format(propertyName)].value if "{0}Max".format(propertyName) in p.properties else 1.0 
+            prop_min = p.getValue("{0}Min".format(propertyName), 0.0)
+            prop_max = p.getValue("{0}Max".format(propertyName), 1.0)
             
             remap_node = nodes.new("ShaderNodeMapRange")
             remap_node.location = nodeLocation
@@ -486,35 +660,49 @@ def setup_materials(r: ResourceResolver):
             remap_node.inputs["To Min"].default_value = prop_min
             remap_node.inputs["To Max"].default_value = prop_max
             
-            mat.node_tree.links.new(outputSocket, remap_node.inputs["Value"])
-            mat.node_tree.links.new(remap_node.outputs["Result"], inputSocket)
+            links_new(outputSocket, remap_node.inputs["Value"])
+            links_new(remap_node.outputs["Result"], inputSocket)
         else:
-            mat.node_tree.links.new(outputSocket, inputSocket)
+            links_new(outputSocket, inputSocket)
         
     
-    for name, mat in bpy.data.materials.items():
+    materials = bpy.data.materials.items()
+    
+    # Reading and building the property files does not touch Blender, so do it for all materials up front on
+    # a thread pool. Setting up the nodes has to happen on the main thread afterwards.
+    # Materials without a property file, such as the ones Blender creates itself, are skipped right away. The
+    # lookup only checks the cached directory listings, so it does not touch the disk for every material.
+    names = [name for name, _ in materials
+             if not name.endswith("EyeFakeHighLight") and r.resolveResourcePath(ResourceType.CHARA_MAT, name) is not None]
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        # The resolver caches every file it builds, so shared parents are normally built once. The cache is not
+        # locked, so two workers that reach the same uncached parent at the same time may both build it, which
+        # only wastes work as both results are equal.
+        property_files = dict(zip(names, executor.map(functools.partial(r.getPropertyFile, ResourceType.CHARA_MAT), names)))
+    
+    for name, mat in materials:
         print("Loading {0}".format(name))
-        data = r.readResource(ResourceType.CHARA_MAT, name)
+        p: PropertyFile = property_files.get(name)
         
         # The FakeEyeHighLight material cannot be read for some reason, so when we encounter another material
         # with data about the eye stored, such as the Eye material, store it in here and use it later.
         
         if name.endswith("EyeFakeHighLight"):
-            data = eye_data
+            p = eye_property_file
         
-        if data:
-            p: PropertyFile = PropertyFile(data, r)
-            p.build()
-            
+        if p:
             # Debug: print property values of this material
             #for propName, propValue in p.properties.items():
                 #print("    {0}: {1}".format(propName, repr(propValue)))
             
             if "Iris UV Radius" in p.properties:
-                eye_data = data
+                eye_property_file = p
             
             mat.use_nodes = True
-            nodes = mat.node_tree.nodes
+            # Every access to mat.node_tree goes through RNA, so only do that once per material
+            node_tree = mat.node_tree
+            nodes = node_tree.nodes
+            links_new = node_tree.links.new
             nodes.clear()
             
             bsdf_node = nodes.new('ShaderNodeBsdfPrincipled')
@@ -522,17 +710,17 @@ def setup_materials(r: ResourceResolver):
             output_node = nodes.new('ShaderNodeOutputMaterial')
             output_node.location = (500,0)
                 
-            mat.node_tree.links.new(bsdf_node.outputs[0], output_node.inputs[0])
+            links_new(bsdf_node.outputs[0], output_node.inputs[0])
             
             if name.endswith("EyeFakeHighLight"):
                 # Set up the eye material
                 base_color_node = nodes.new("ShaderNodeGroup")
                 base_color_node.location = (-200, 0)
                 base_color_node.node_tree = get_eye_highlight_node(r)
-                base_color_node.inputs["Iris UV Radius"].default_value = p.properties["Iris UV Radius"].value
-                base_color_node.inputs["Iris Color"].default_value =  p.properties["CreationColor1"].value
+                base_color_node.inputs["Iris UV Radius"].default_value = p.getValue("Iris UV Radius")
+                base_color_node.inputs["Iris Color"].default_value =  p.getValue("CreationColor1")
                 
-                mat.node_tree.links.new(base_color_node.outputs["Base Color"], bsdf_node.inputs["Base Color"])
+                links_new(base_color_node.outputs["Base Color"], bsdf_node.inputs["Base Color"])
                 
                 normal_tex_node = create_texture_node("EYE_NORMALS")
                 normal_tex_node.location = (-600, -400)
@@ -540,8 +728,8 @@ def setup_materials(r: ResourceResolver):
                 normal_map_node = nodes.new("ShaderNodeNormalMap")
                 normal_map_node.location = (-200, -400)
                 
-                mat.node_tree.links.new(normal_tex_node.outputs["Color"], normal_map_node.inputs["Color"])
-                mat.node_tree.links.new(normal_map_node.outputs["Normal"], bsdf_node.inputs["Normal"])
+                links_new(normal_tex_node.outputs["Color"], normal_map_node.inputs["Color"])
+                links_new(normal_map_node.outputs["Normal"], bsdf_node.inputs["Normal"])
             
             elif name.endswith("Eye"):
                 # Set up the EyeLash material
@@ -554,29 +742,36 @@ def setup_materials(r: ResourceResolver):
                 mix_node.inputs["Fac"].default_value = 1.0
                 mix_node.inputs["Color2"].default_value = (0, 0, 0, 0)
                 
-                mat.node_tree.links.new(base_color_node.outputs["Color"], mix_node.inputs["Color1"])
-                mat.node_tree.links.new(mix_node.outputs["Color"], bsdf_node.inputs["Base Color"])
-                mat.node_tree.links.new(base_color_node.outputs["Alpha"], bsdf_node.inputs["Alpha"])
+                links_new(base_color_node.outputs["Color"], mix_node.inputs["Color1"])
+                links_new(mix_node.outputs["Color"], bsdf_node.inputs["Base Color"])
+                links_new(base_color_node.outputs["Alpha"], bsdf_node.inputs["Alpha"])
                 
             else:
                 # Set up other materials
-                if "Anisotropy" in p.properties:
-                    bsdf_node.inputs["Anisotropic"].default_value = p.properties["Anisotropy"].value
+                # Texture nodes of this material by property name, for the fixups below
+                texture_nodes: dict[str, bpy.types.ShaderNodeTexImage] = {}
                 
-                if "Metallic" in p.properties:
-                    bsdf_node.inputs["Metallic"].default_value = p.properties["Metallic"].value
+                anisotropy = p.getValue("Anisotropy")
+                if anisotropy is not None:
+                    bsdf_node.inputs["Anisotropic"].default_value = anisotropy
+                
+                metallic = p.getValue("Metallic")
+                if metallic is not None:
+                    bsdf_node.inputs["Metallic"].default_value = metallic
                     
-                if "IoR" in p.properties:
-                    bsdf_node.inputs["IOR"].default_value = p.properties["IoR"].value
+                ior = p.getValue("IoR")
+                if ior is not None:
+                    bsdf_node.inputs["IOR"].default_value = ior
                 
-                if "BaseColor" in p.properties:
-                    base_color_node = create_texture_node(p.properties["BaseColor"])
+                base_color = p.properties.get("BaseColor")
+                if base_color is not None:
+                    base_color_node = create_texture_node(base_color)
+                    texture_nodes["BaseColor"] = base_color_node
                     
-                    if "OpacityMax" in p.properties and "OpacityMin" in p.properties:
+                    opacity_max = p.getValue("OpacityMax")
+                    opacity_min = p.getValue("OpacityMin")
+                    if opacity_max is not None and opacity_min is not None:
                         # Handle a custom alpha ramp if it is set
-                        opacity_max = p.properties["OpacityMax"].value
-                        opacity_min = p.properties["OpacityMin"].value
-                        
                         opacity_ramp_node = nodes.new("ShaderNodeValToRGB")
                         opacity_ramp_node.location = (-900, -500)
                         
@@ -584,79 +779,85 @@ def setup_materials(r: ResourceResolver):
                         opacity_ramp_node.color_ramp.elements[0].alpha = opacity_min
                         opacity_ramp_node.color_ramp.elements[1].alpha = opacity_max
                         
-                        if "OpacityMiddle" in p.properties and "OpacityMiddlePoint" in p.properties:
+                        opacity_middle       = p.getValue("OpacityMiddle")
+                        opacity_middle_point = p.getValue("OpacityMiddlePoint")
+                        if opacity_middle is not None and opacity_middle_point is not None:
                             # Add a middle point
-                            opacity_middle       = p.properties["OpacityMiddle"].value
-                            opacity_middle_point = p.properties["OpacityMiddlePoint"].value
-                            
                             middle_element = opacity_ramp_node.color_ramp.elements.new(opacity_middle_point)
                             middle_element.color = (1, 1, 1, 1)
                             middle_element.alpha = opacity_middle
                         
-                        mat.node_tree.links.new(base_color_node.outputs["Alpha"],   opacity_ramp_node.inputs["Fac"])
-                        mat.node_tree.links.new(opacity_ramp_node.outputs["Alpha"], bsdf_node.inputs["Alpha"])
+                        links_new(base_color_node.outputs["Alpha"],   opacity_ramp_node.inputs["Fac"])
+                        links_new(opacity_ramp_node.outputs["Alpha"], bsdf_node.inputs["Alpha"])
                     else:
-                        mat.node_tree.links.new(base_color_node.outputs["Alpha"], bsdf_node.inputs["Alpha"])
+                        links_new(base_color_node.outputs["Alpha"], bsdf_node.inputs["Alpha"])
                     
                     
-                    if "CreationMask" in p.properties:
+                    creation_mask = p.properties.get("CreationMask")
+                    if creation_mask is not None:
                         # Creates a group of nodes that replaces the color of the mask with another color
                         base_color_node.location = (-1500, -300)
-                        creation_mask_texture_node = create_texture_node(p.properties["CreationMask"])
+                        creation_mask_texture_node = create_texture_node(creation_mask)
                         creation_mask_texture_node.label = "Creation Mask"
                         creation_mask_texture_node.location = (-1500, 0)
+                        texture_nodes["CreationMask"] = creation_mask_texture_node
                         
                         creation_mask_node = nodes.new("ShaderNodeGroup")
                         creation_mask_node.location = (-600, 200)
                         creation_mask_node.node_tree = get_creation_mask_node()
                         
-                        mat.node_tree.links.new(base_color_node.outputs["Color"], creation_mask_node.inputs["Base Color"])
-                        mat.node_tree.links.new(creation_mask_texture_node.outputs["Color"], creation_mask_node.inputs["Creation Mask"])
-                        mat.node_tree.links.new(creation_mask_texture_node.outputs["Alpha"], creation_mask_node.inputs["Creation Mask Alpha"])
+                        # Socket collections are looked up through RNA, so only fetch them once
+                        creation_mask_inputs = creation_mask_node.inputs
+                        creation_mask_texture_outputs = creation_mask_texture_node.outputs
                         
-                        creation_valid_mask = p.properties["CreationValidMask"].value
+                        links_new(base_color_node.outputs["Color"],            creation_mask_inputs["Base Color"])
+                        links_new(creation_mask_texture_outputs["Color"],      creation_mask_inputs["Creation Mask"])
+                        links_new(creation_mask_texture_outputs["Alpha"],      creation_mask_inputs["Creation Mask Alpha"])
+                        
+                        creation_valid_mask = p.getValue("CreationValidMask")
                         
                         for i, valid in enumerate(creation_valid_mask):
                             if valid != 0.0:
-                                creation_color_prop_name = "CreationColor{0}".format(i + 1)
-                                if creation_color_prop_name in p.properties:
-                                    color = p.properties[creation_color_prop_name].value
-                                else:
-                                    color = (0, 0, 0, 1)
-                                creation_mask_node.inputs["Color {0}".format(i + 1)].default_value = color
+                                color = p.getValue(CREATION_COLOR_PROPERTIES[i], (0, 0, 0, 1))
+                                creation_mask_inputs[CREATION_COLOR_INPUTS[i]].default_value = color
+                            else:
+                                # Leave the masked area of this colour untouched
+                                creation_mask_inputs[CREATION_VALID_INPUTS[i]].default_value = 0.0
                                
                         
-                        base_color_link = mat.node_tree.links.new(creation_mask_node.outputs["Color"], bsdf_node.inputs["Base Color"])
+                        base_color_link = links_new(creation_mask_node.outputs["Color"], bsdf_node.inputs["Base Color"])
                     else:
                         # If there is no creation mask, connect it directly to the bsdf node
                         base_color_node.location = (-1000, 0)
-                        base_color_link = mat.node_tree.links.new(base_color_node.outputs["Color"], bsdf_node.inputs["Base Color"])
+                        base_color_link = links_new(base_color_node.outputs["Color"], bsdf_node.inputs["Base Color"])
                 
-                if "NormalMap" in p.properties:
-                    normal_tex_node = create_texture_node(p.properties["NormalMap"])
+                normal_map = p.properties.get("NormalMap")
+                if normal_map is not None:
+                    normal_tex_node = create_texture_node(normal_map)
                     normal_tex_node.location = (-500, -600)
                     
                     normal_map_node = nodes.new("ShaderNodeNormalMap")
                     normal_map_node.location = (-250, -600)
                     
-                    mat.node_tree.links.new(normal_tex_node.outputs["Color"], normal_map_node.inputs["Color"])
-                    mat.node_tree.links.new(normal_map_node.outputs["Normal"], bsdf_node.inputs["Normal"])
+                    links_new(normal_tex_node.outputs["Color"], normal_map_node.inputs["Color"])
+                    links_new(normal_map_node.outputs["Normal"], bsdf_node.inputs["Normal"])
                     
-                if "ParameterMap" in p.properties:
+                parameter_map = p.properties.get("ParameterMap")
+                if parameter_map is not None:
                     # http://modderbase.com/showthread.php?tid=1878
                     # Red Channel: Specular
                     # Green Channel: Roughness
                     # Blue Channel: Metalness
                     # Alpha Channel: ???
-                    param_map_node = create_texture_node(p.properties["ParameterMap"])
+                    param_map_node = create_texture_node(parameter_map)
                     param_map_node.location = (-900, -250)
                     param_map_split_node = nodes.new("ShaderNodeSeparateRGB")
                     param_map_split_node.location = (-600, -200)
                     
-                    mat.node_tree.links.new(param_map_node.outputs["Color"],   param_map_split_node.inputs["Image"]) 
+                    links_new(param_map_node.outputs["Color"],   param_map_split_node.inputs["Image"]) 
                     add_remap_nodes("Specular",  param_map_split_node.outputs["R"], bsdf_node.inputs["Specular"],  (-400, -100))
                     add_remap_nodes("Roughness", param_map_split_node.outputs["G"], bsdf_node.inputs["Roughness"], (-200, -200))
-                    mat.node_tree.links.new(param_map_split_node.outputs["B"], bsdf_node.inputs["Metallic"])
+                    links_new(param_map_split_node.outputs["B"], bsdf_node.inputs["Metallic"])
                     
                     mix_ao_node = nodes.new("ShaderNodeMixRGB")
                     mix_ao_node.blend_type = "MULTIPLY"
@@ -664,21 +865,16 @@ def setup_materials(r: ResourceResolver):
                     mix_ao_node.inputs["Fac"].default_value = 1.0
                     
                     #base_color_link.to_socket = mix_ao_node.inputs["Color1"]
-                    mat.node_tree.links.new(base_color_link.from_socket,   mix_ao_node.inputs["Color1"])
-                    mat.node_tree.links.new(param_map_node.outputs["Alpha"],   mix_ao_node.inputs["Color2"])
-                    mat.node_tree.links.new(mix_ao_node.outputs["Color"], bsdf_node.inputs["Base Color"])
+                    links_new(base_color_link.from_socket,   mix_ao_node.inputs["Color1"])
+                    links_new(param_map_node.outputs["Alpha"],   mix_ao_node.inputs["Color2"])
+                    links_new(mix_ao_node.outputs["Color"], bsdf_node.inputs["Base Color"])
                 
                 # Some hard-coded material fixups until the material loading is done correclty
-                if name.endswith("Eyebrow"):
-                    # Patch some mistakes on the eyebrow material
-                    creation_mask_texture_path = r.resolveResourcePath(ResourceType.TEXTURE_2D, "red_16x16")
-                    creation_mask_texture_node.image = bpy.data.images.load(bytes(creation_mask_texture_path), check_existing=True)   
-                    
-                    param_mask_texture_path = r.resolveResourcePath(ResourceType.TEXTURE_2D, "black_16x16")
-                    creation_mask_texture_node.image = bpy.data.images.load(bytes(param_mask_texture_path), check_existing=True)   
-                elif name.endswith("Tear"):
-                    base_color_texture_path = r.resolveResourcePath(ResourceType.TEXTURE_2D, "FACE_namida_COLOR")
-                    base_color_node.image = bpy.data.images.load(bytes(param_mask_texture_path), check_existing=True)
+                if name.endswith(MATERIAL_FIXUP_SUFFIXES):
+                    for suffix, fixup in MATERIAL_FIXUPS.items():
+                        if name.endswith(suffix):
+                            fixup(r, texture_nodes, img_cache)
+                            break
                     
 if __name__ == "__main__":
     r: ResourceResolver = ResourceResolver()